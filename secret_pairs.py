@@ -36,21 +36,18 @@ It should be in the following format
 
 import argparse
 import json
-import os
 import random
+import re
+import secrets
 import sys
 
-from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from functools import reduce
-from zipfile import ZipFile
+from zipfile import ZIP_STORED, ZipFile, ZipInfo
 
 _debug = False
 
-# For secrecy padding
-BASE64 = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz1234567890+/='
-
-# Validate that a given name is in names, and report if not
+# Validate that a given name is in the set of names, and report if not
 def check_name(name, names, member = None):
     if name not in names:
         if member is not None:
@@ -58,28 +55,37 @@ def check_name(name, names, member = None):
         sys.exit("Invalid participant " + name);
 
 
-# From the JSON file, load names, fixed, and block
+# From the JSON file, load names, fixed, block, and zipnames
+# zipnames maps each name to the zip file their result is written to
+# Names are interned to integer IDs (their index in names) for pair generation:
+# fixed[who] is the ID who must be given, or -1 if they're free, and
+# block[who] is a bitmask with bit N set if who must not be given ID N
 def load_data(data):
     # Everyone who is participating
     names = data["names"]
+    # For validating names without searching the whole list each time
+    names_set = set(names);
 
     # One way enforcement: key must be paired with value
     fixed = data["force"]
     # Check validity
     for key,value in fixed.items():
-        check_name(key, names, "force");
-        check_name(value, names, "force");
+        check_name(key, names_set, "force");
+        check_name(value, names_set, "force");
 
     # One way enforcement: key must not be paired with value
     block = data["block"]
     # Check validity
     for key,value in block.items():
-        check_name(key, names, "block");
-        if type(value) is not list:
+        check_name(key, names_set, "block");
+        # Either a single name, or a list of them
+        if isinstance(value, str):
             value = [value];
+        elif not isinstance(value, list) or not all(isinstance(name, str) for name in value):
+            sys.exit(key + " in 'block' must be given a name or a list of names");
         block[key] = set(value);
         for name in block[key]:
-            check_name(name, names, "block");
+            check_name(name, names_set, "block");
 
     # Two way enforcement: Entries fixed to each other
     givens = data["twoway_force"]
@@ -88,8 +94,8 @@ def load_data(data):
         left = given[0];
         right = given[1];
         # And check validity
-        check_name(left, names, "twoway_force");
-        check_name(right, names, "twoway_force");
+        check_name(left, names_set, "twoway_force");
+        check_name(right, names_set, "twoway_force");
         # If they've already been fixed, we'd overwrite it ahead
         if left in fixed or right in fixed:
             sys.exit("Conflicting force requirements with " + left + " and " + right)
@@ -103,112 +109,233 @@ def load_data(data):
         left = forbid[0];
         right = forbid[1];
         # Also, check validity!
-        check_name(left, names, "twoway_block");
-        check_name(right, names, "twoway_block");
+        check_name(left, names_set, "twoway_block");
+        check_name(right, names_set, "twoway_block");
         # Then set up blocks
         if left in block: block[left].add( right );
         else: block[left] = set([right]);
         if right in block: block[right].add( left );
         else: block[right] = set([left]);
     # TODO: Add more validation
-    return (names,fixed,block)
-
-
-# Given a name, a list of unchosen names, and the fix/block lists,
-# return all the possible names they could be paired with
-def eligible_for(name, picks, fixed, block):
-    # If they've got someone who must go to them
-    if name in fixed:
-        return [fixed[name]]
 
-    # Final list of eligible picks
-    finals = [];
-    for person in picks:
-        # We can't pick ourselves
-        if person == name:
-            continue;
-        # And we can't pick anyone who we blocked
-        if name in block and person in block[name]:
-            continue;
-        finals.append(person);
-
-    return finals;
-
-
-# Given the names and fix/block lists, randomly generate pairs
-def gen_pairs(names, fixed, block):
-    unpaired = names.copy();
-    picks_left = names.copy();
-    for pick in fixed.values():
-        picks_left.remove(pick)
+    # Translate everything to IDs, so pair generation only works with ints
+    name_to_id = {name: i for i, name in enumerate(names)};
+    fixed_ids = [-1] * len(names);
+    for key,value in fixed.items():
+        fixed_ids[name_to_id[key]] = name_to_id[value];
+    block_ids = [0] * len(names);
+    for key,value in block.items():
+        for name in value:
+            block_ids[name_to_id[key]] |= 1 << name_to_id[name];
+
+    # Anything that could upset a filesystem is swapped for _ in zip names,
+    # which mustn't leave two people writing to the same file
+    # Some filesystems ignore case, so names are compared case-insensitively
+    zipnames = {};
+    zipname_owners = {};
+    for name in names:
+        zipname = re.sub(r"[^\w.-]", "_", name) + ".zip";
+        folded = zipname.casefold();
+        if folded in zipname_owners:
+            other = zipname_owners[folded];
+            sys.exit(name + " and " + other + " would both be written to " + zipnames[other]);
+        zipname_owners[folded] = name;
+        zipnames[name] = zipname;
+    return (names,fixed_ids,block_ids,zipnames)
+
+
+# Yield the index of each bit set in mask, lowest first
+def bits_of(mask):
+    while mask:
+        low = mask & -mask;
+        yield low.bit_length() - 1;
+        mask ^= low;
+
+
+# Number of bits set in mask
+def count_bits(mask):
+    return bin(mask).count("1");
+
+
+# Given an ID, a bitmask of unchosen IDs, and the allowed bitmasks from
+# gen_pairs, return a bitmask of all the possible IDs they could be paired with
+def eligible_for(name, picks, allowed):
+    return picks & allowed[name];
+
+
+# Try to give who one of picks, moving people who were already given a pick
+# on to another one where needed (along an augmenting path)
+# owner[pick] is who was given pick and given[who] is the pick who was given,
+# both -1 if there's none. They're only changed if who could be given a pick
+def augment(who, picks, allowed, owner, given):
+    # Search breadth first from who, remembering who each pick was reached from
+    reached_from = {};
+    seen = 0;
+    frontier = [who];
+    while frontier:
+        next_frontier = [];
+        for person in frontier:
+            for pick in bits_of(eligible_for(person, picks, allowed) & ~seen):
+                seen |= 1 << pick;
+                reached_from[pick] = person;
+                if owner[pick] != -1:
+                    next_frontier.append(owner[pick]);
+                    continue;
+                # Found a free pick. Everyone on the way there moves on to the
+                # pick they reached next, back to who
+                while pick != -1:
+                    person = reached_from[pick];
+                    previous = given[person];
+                    owner[pick] = person;
+                    given[person] = pick;
+                    pick = previous;
+                return True;
+        frontier = next_frontier;
+    return False;
+
+
+# Give everyone in the people bitmask one of picks, with no two given the same
+# Returns (owner, given) as described for augment, or None if it can't be done
+def find_matching(count, people, picks, allowed):
+    owner = [-1] * count;
+    given = [-1] * count;
+    for who in bits_of(people):
+        if not augment(who, picks, allowed, owner, given):
+            return None;
+    return (owner, given);
+
+
+# Change the matching in owner and given (as described for augment) so who is
+# given pick, and everyone else in it is still given one of picks
+# Returns whether that's possible. owner and given are only changed if it is
+def rematch(who, pick, picks, allowed, owner, given):
+    previous = given[who];
+    if previous == pick:
+        return True;
+
+    # Whoever had pick needs a new one, and the pick who had is free for them
+    other = owner[pick];
+    given[who] = pick;
+    owner[pick] = who;
+    owner[previous] = -1;
+    given[other] = -1;
+    if augment(other, picks, allowed, owner, given):
+        return True;
+
+    # No luck, put it all back
+    given[who] = previous;
+    owner[previous] = who;
+    given[other] = pick;
+    owner[pick] = other;
+    return False;
+
+
+# Without any fixes or blocks, any shuffle where nobody gets themselves will do
+# Reshuffle until that's true, which takes about e (2.7...) tries on average
+def gen_pairs_unconstrained(count, rng):
+    picks = list(range(count));
+    while True:
+        rng.shuffle(picks);
+        if all(who != pick for who, pick in enumerate(picks)):
+            return dict(enumerate(picks));
+
+
+# Given the names and fix/block lists, randomly generate pairs using rng
+# The pairs are returned as IDs, matching the indices of names
+def gen_pairs(names, fixed, block, rng):
+    # No need to search if there's nothing to satisfy
+    if len(names) > 1 and not any(block) and all(pick == -1 for pick in fixed):
+        return gen_pairs_unconstrained(len(names), rng);
+
+    everyone = (1 << len(names)) - 1;
+    # For each ID, a bitmask of the IDs they could ever be given: not
+    # themselves, and not anyone they've blocked
+    allowed = [everyone & ~block[who] & ~(1 << who) for who in range(len(names))];
+
+    # Bitmask, bit N is set if ID N hasn't been given anyone yet
+    unpaired = everyone;
+    # Bitmask, bit N is set if ID N hasn't been given to anyone yet
+    picks_left = everyone;
+    # Fixed pairs need no choosing, so make them all up front and only search
+    # for the rest
     pairs = dict();
-    ret = gen_pairs_rec(pairs, unpaired, picks_left, deepcopy(fixed), deepcopy(block));
-    if ret is None:
+    for who, pick in enumerate(fixed):
+        if pick == -1:
+            continue;
+        if not picks_left & (1 << pick):
+            sys.exit("Conflicting force requirements with " + names[pick]);
+        pairs[who] = pick;
+        unpaired &= ~(1 << who);
+        picks_left &= ~(1 << pick);
+
+    # Make sure there's any way to pair everyone before searching. This takes
+    # polynomial time, where a search could try every arrangement first
+    matching = find_matching(len(names), unpaired, picks_left, allowed);
+    if matching is None:
         sys.exit("Pair generation failed! Too many constraints.");
-    return ret;
-
-
-# Try to pick a pair, functional style
-# On success, call recursively with the pair eliminated from the data
-# If the recursive call fails, pick again, then try another recursive call
-# If all recursive calls fail, fail up to the next level, and so on
-def gen_pairs_rec(pairs, unpaired, picks_left, fixed, block):
-    # Base case - all pairs chosen
-    if len(unpaired) == 0 and len(picks_left) == 0:
-        return pairs;
-
-    # Who we'll try to match up
-    who = random.choice(unpaired);
-    # Give priority to those with fixed pairs
-    for priority in fixed.keys():
-        if priority in unpaired:
-            who = priority;
-            break;
-
-    while True:
-        # Valid picks. If we've exhausted all valid picks, fail and see if
-        # a different configuration works
-        options = eligible_for(who, picks_left, fixed, block)
-        if len(options) == 0:
+    owner, given = matching;
+
+    # Who to pair up, in a random order
+    order = list(bits_of(unpaired));
+    rng.shuffle(order);
+
+    return gen_pairs_loop(names, pairs, unpaired, picks_left, allowed, owner, given, order, rng);
+
+
+# Pick pairs at random, one at a time, adding them to pairs until everyone in
+# order is paired. names is only used to show IDs in debug output
+# owner and given hold a way to give everyone still unpaired one of picks_left
+# (see augment). Each pick keeps that true, so a pick never leads to a dead end
+# and there's never any need to go back and pick again
+def gen_pairs_loop(names, pairs, unpaired, picks_left, allowed, owner, given, order, rng):
+    if _debug:
+        for who in order:
+            print(names[who] + " may be given: " + str([names[pick] for pick in bits_of(allowed[who])]));
+
+    for who in order:
+        # Each pick pairs one person with one pick, so there's always as many
+        # picks left as people unpaired
+        assert count_bits(picks_left) == count_bits(unpaired);
+
+        # Try the valid picks in a random order, and take the first that
+        # leaves everyone else with a pick. There's always one: who's pick in
+        # the matching
+        options = list(bits_of(eligible_for(who, picks_left, allowed)));
+        rng.shuffle(options);
+        for pick in options:
+            if rematch(who, pick, picks_left & ~(1 << pick), allowed, owner, given):
+                break;
             if _debug:
-                print("Found no options for " + who);
-                print(str(pairs));
-            return None
+                print(names[who] + " cannot pair with " + names[pick]
+                        + " without leaving someone else with no valid pick");
 
-        # Pick a random valid choice
-        pick = random.choice(options);
+        # Modify the data so it's correct for the next pick
+        pairs[who] = pick;
+        unpaired &= ~(1 << who);
+        picks_left &= ~(1 << pick);
 
-        # Copy all the data to give on to the next pick
-        pairs_copy = pairs.copy();
-        unpaired_copy = unpaired.copy();
-        picks_left_copy = picks_left.copy();
+        if _debug:
+            print("Paired " + names[who] + " with: " + names[pick]);
+            print("\tPicks Left: " + str([names[left] for left in bits_of(picks_left)]));
+            print("\tUnpaired: " + str([names[person] for person in bits_of(unpaired)]));
 
-        # Modify that data so it's correct for the next pick
-        pairs_copy[who] = pick;
-        if who in unpaired:
-            unpaired_copy.remove(who);
-        if pick in picks_left:
-            picks_left_copy.remove(pick);
+    # All pairs chosen, so all picks are gone too
+    assert picks_left == 0;
+    return pairs;
 
 
-        if _debug:
-            print("Paired " + who + " with: " + pick);
-            print("\tPicks Left: " + str(picks_left_copy));
-            print("\tUnpaired: " + str(unpaired_copy));
-            print("\tfixes: " + str(fixed));
-            print("\tblocks: " + str(block));
-        ret = gen_pairs_rec(pairs_copy, unpaired_copy, picks_left_copy, deepcopy(fixed), deepcopy(block));
-        # If the recursive call succeeded, we found our pairs, pass them up
-        if ret is not None:
-            return ret;
-
-        # Otherwise, we failed! Block this pick and try a different one
-        if _debug:
-            print("Due to restrictions below " + who + " cannot pair with " + pick);
-        if who in block:
-            block[who].add(pick);
-        else:
-            block[who] = set([pick]);
+# Write the zip file zipname, containing an anonymous text file with the pair
+# its participant was given and the padding
+def write_assignment(zipname, pair, padding):
+    # The file is built in memory, nothing else touches the disk
+    # It's a single bytes object stored as-is, so the only work zipfile does
+    # on it is one CRC-32 pass in C
+    payload = (pair + '\nSecret Padding: ' + padding + '\n').encode("utf-8");
+    info = ZipInfo("assignment.txt", date_time=datetime.now().timetuple()[:6]);
+    info.compress_type = ZIP_STORED;
+    info.external_attr = 0o600 << 16;
+    with ZipFile(zipname, "w") as azip:
+        azip.writestr(info, payload);
 
 
 def main():
@@ -227,13 +354,14 @@ def main():
     parser.add_argument("-c", "--cheat", help="show final results",
             action='store_true');
     parser.add_argument("-s", "--seed", metavar="SEED", type=int,
-            help="Seed RNG with SEED",
-            default=int(datetime.now().timestamp() * 1000000000))
+            help="Seed RNG with SEED (default: a random 64 bit number)",
+            default=secrets.randbits(64))
     #parser.add_argument("-o", "--out", metavar="OUT", type=str,
     #        help='output directory for zip files', default="");
     args = parser.parse_args();
 
-    random.seed(args.seed);
+    # All the randomness in pairing comes from here, so SEED reproduces it
+    rng = random.Random(args.seed);
 
     start_time = datetime.now().timestamp();
 
@@ -244,20 +372,24 @@ def main():
     # Who's gonna be involved in selection
     # List of string. Everyone who is participating in pairing process
     names = []
-    # Dictionary matching string to string. Each key and value will be in names
+    # List of int, one per name. Each value is -1 or an index into names
     # Pairs that must show up in the output
-    fixed = {}
-    # Dictionary matching string to set of string.
-    # Each key will be in names, and each element of the set will be in names
-    # In the final output, key cannot be matched with any element of value
-    block = {}
+    fixed = []
+    # List of int bitmasks, one per name. Each bit is an index into names
+    # In the final output, name cannot be matched with any bit set in the mask
+    block = []
+    # Dictionary matching string to string. Each key will be in names
+    # The file each name's result is written to, unique to them
+    zipnames = {}
     with open(args.param_file, "r", encoding="utf-8") as json_file:
         data = json.load(json_file);
-        names,fixed,block = load_data(data);
+        names,fixed,block,zipnames = load_data(data);
 
     if _debug or args.verbose:
         print("RNG Seed is: " + str(args.seed));
-    out = gen_pairs(names, fixed, block);
+    out = gen_pairs(names, fixed, block, rng);
+    # Back from IDs to the names to write out
+    out = {names[who]: names[pick] for who, pick in out.items()};
 
     if _debug or args.cheat:
         print(out);
@@ -266,27 +398,27 @@ def main():
 
     # How long each file must be, to ensure file size doesn't give away names
     # Length of longest name + 5
-    pad_to = len(reduce(lambda l, r: l if len(l) > len(r) else r, out.values())) + 5;
-
-    # Generate the output files
-    for name, pair in out.items():
-        # Write the given name into this file
-        filename = str(os.getpid()) + "-assignment.txt";
-        with open(filename, 'w') as writer:
-            writer.write(pair)
-            writer.write('\n')
-            # Pad for secrecy
-            writer.write('Secret Padding: ')
-            for i in range(len(pair) + 1, pad_to):
-                writer.write(random.choice(BASE64))
-            writer.write('\n');
-        # Zip this anonymous file into a zip file with the name of the person
-        # who it was given to, to allow delivery
-        zipname = name.replace(" ", "_") + ".zip";
-        with ZipFile(zipname, "w") as azip:
-                azip.write(filename);
-        if _debug or args.verbose:
-            print(f"Wrote result for {name} into {zipname}");
+    pad_to = max(map(len, out.values())) + 5;
+
+    # Pad for secrecy. This comes from the OS's secure source, not the seeded
+    # RNG, so the padding can't be predicted from the seed or the time
+    # Everyone's padding is cut from a single draw
+    lengths = [pad_to - len(pair) - 1 for pair in out.values()];
+    pool = secrets.token_urlsafe(sum(lengths));
+    paddings = [];
+    start = 0;
+    for length in lengths:
+        paddings.append(pool[start:start + length]);
+        start += length;
+
+    # Generate the output files. Each is independent and the work is almost
+    # all file I/O, so write them from a pool of threads
+    with ThreadPoolExecutor() as executor:
+        written = executor.map(write_assignment, [zipnames[name] for name in out],
+                out.values(), paddings);
+        for name, _ in zip(out.keys(), written):
+            if _debug or args.verbose:
+                print(f"Wrote result for {name} into {zipnames[name]}");
     delta_time = datetime.now().timestamp() - start_time;
     print(f"Wrote results for {len(out)} participants in {delta_time:0.5f}s");
 
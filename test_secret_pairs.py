@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+"""
+Check gen_pairs against a brute force search over every permutation
+Run with: python3 -m unittest test_secret_pairs
+"""
+
+import itertools
+import random
+import unittest
+
+from secret_pairs import gen_pairs
+
+# Largest number of participants to check; brute force is n! permutations
+MAX_NAMES = 7
+# Random constraint sets to check for each number of participants
+TRIALS = 300
+
+
+# Whether pairs (pairs[who] is the ID given to who) satisfies fixed and block
+def valid(pairs, fixed, block):
+    for who, pick in enumerate(pairs):
+        if fixed[who] != -1:
+            if pick != fixed[who]:
+                return False;
+        elif pick == who or block[who] & (1 << pick):
+            return False;
+    return True;
+
+
+# Whether any pairing at all satisfies fixed and block
+def possible(count, fixed, block):
+    return any(valid(pairs, fixed, block)
+            for pairs in itertools.permutations(range(count)));
+
+
+class TestGenPairs(unittest.TestCase):
+    def check(self, count, fixed, block, seed):
+        names = [str(i) for i in range(count)];
+        expected = possible(count, fixed, block);
+        try:
+            out = gen_pairs(names, fixed, block, random.Random(seed));
+        except SystemExit:
+            self.assertFalse(expected, f"exited, but pairing is possible: {fixed} {block}");
+            return;
+        self.assertTrue(expected, f"paired, but pairing is impossible: {fixed} {block}");
+        self.assertEqual(sorted(out.keys()), list(range(count)));
+        pairs = [out[who] for who in range(count)];
+        self.assertEqual(sorted(pairs), list(range(count)));
+        self.assertTrue(valid(pairs, fixed, block), f"invalid pairs {out}: {fixed} {block}");
+
+    # Every possible set of blocks for up to three people
+    def test_all_blocks_small(self):
+        for count in range(1, 4):
+            for masks in itertools.product(range(1 << count), repeat=count):
+                self.check(count, [-1] * count, list(masks), 0);
+
+    # Random blocks and fixed pairs for more people
+    def test_random_constraints(self):
+        rng = random.Random(0);
+        for count in range(2, MAX_NAMES + 1):
+            for trial in range(TRIALS):
+                fixed = [-1] * count;
+                for who in rng.sample(range(count), rng.randint(0, 2)):
+                    fixed[who] = rng.choice([pick for pick in range(count) if pick != who]);
+                block = [rng.getrandbits(count) if rng.random() < 0.6 else 0
+                        for _ in range(count)];
+                self.check(count, fixed, block, trial);
+
+
+if __name__ == "__main__":
+    unittest.main()